@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
+import gzip
 import json
 import os
+import pickle
+import sys
 import time
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from typing import Any, Callable, TypedDict
 from urllib.error import HTTPError
 from urllib.request import urlopen, Request
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # fall back to the stdlib json module
+
 URL_BASE = "https://api.nextdns.io/profiles/{}"
 URL_TMPL = URL_BASE + "/logs?status=blocked&limit=1000"
 URL_RETRIES = 3
@@ -18,7 +28,20 @@ DomData = dict[str, set[str]]  # d[domain] = set[blists]
 DomDataFile = dict[str, list[str]]  # d[domain] = list[blists]
 BlistData = dict[str, set[str]]  # d[blist_id] = set[domains]
 
-DOMDATA_FNAME_TMPL = "{}.domdata.json"
+DOMDATA_FNAME_TMPL = "{}.domdata.pickle"
+DOMDATA_JSON_FNAME_TMPL = "{}.domdata.json"  # JSON export; stores were JSON before
+
+
+def json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(data: Any, indent: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(data, indent=2 if indent else None).encode()
 
 
 class ConfigJson(TypedDict):
@@ -27,22 +50,24 @@ class ConfigJson(TypedDict):
 
 
 def json_to_domdata(jsondata: NextDnsJson) -> DomData:
-    output: DomData = {}
-
-    for entry in jsondata:
-        blocklists = {r["id"] for r in entry["reasons"]}
-        output[entry["domain"]] = blocklists
-
-    return output
+    # Blocklist ids repeat across every entry. Interning them means each id
+    # is a single object, so set ops and sorts hit the identity fast path.
+    intern = sys.intern
+    return {
+        entry["domain"]: {intern(r["id"]) for r in entry["reasons"]}
+        for entry in jsondata
+    }
 
 
 def domdata_to_blistdata(domdata: DomData) -> BlistData:
-    blistdata: BlistData = defaultdict(set)
+    # group into lists first; building each set from a list happens in C
+    grouped: dict[str, list[str]] = defaultdict(list)
 
-    for dom in domdata:
-        for blist in domdata[dom]:
-            blistdata[blist].add(dom)
+    for dom, blists in domdata.items():
+        for blist in blists:
+            grouped[blist].append(dom)
 
+    blistdata: BlistData = {blist: set(doms) for blist, doms in grouped.items()}
     return blistdata
 
 
@@ -55,7 +80,14 @@ def get_api_data(api_key: str, profile_id: str, keep: bool = False) -> NextDnsJs
     for tries in range(URL_RETRIES + 1):
         try:
             resp = urlopen(
-                Request(url, headers={"X-Api-Key": api_key, "User-Agent": "Phi/1.618"})
+                Request(
+                    url,
+                    headers={
+                        "X-Api-Key": api_key,
+                        "User-Agent": "Phi/1.618",
+                        "Accept-Encoding": "gzip",
+                    },
+                )
             )
             break
         except HTTPError:
@@ -65,41 +97,70 @@ def get_api_data(api_key: str, profile_id: str, keep: bool = False) -> NextDnsJs
             time.sleep(20)
 
     assert resp is not None, "Somehow, `resp` is still None. This shouldn't happen."
-    data: NextDnsJson = json.loads(resp.read())
+    body = resp.read()
+    gzipped = resp.headers.get("Content-Encoding") == "gzip"
 
+    # save the response as received rather than re-serializing the parsed data
     if keep:
         fname = "{}-{}.log.json".format(profile_id, time.time())
-        with open(fname, "w") as fo:
-            json.dump(data, fo)
+        if gzipped:
+            fname += ".gz"
+        with open(fname, "wb") as fo:
+            fo.write(body)
             print("💾 Wrote", fname)
 
+    if gzipped:
+        body = gzip.decompress(body)
+    data: NextDnsJson = json_loads(body)
+    del body  # don't hold the raw payload alongside the parsed tree
+
     print("✅ Found {} log entries".format(len(data["data"])))
     return json_to_domdata(data["data"])
 
 
 def get_file_data(fname: str) -> NextDnsJson:
-    with open(fname, "r") as fi:
+    opener = gzip.open if fname.endswith(".gz") else open
+    with opener(fname, "rb") as fi:
         print("💾 Loading JSON from", fname)
-        data: NextDnsJson = json.load(fi)
+        data: NextDnsJson = json_loads(fi.read())
 
     print("✅ Found {} log entries".format(len(data["data"])))
     return json_to_domdata(data["data"])
 
 
-def get_domdata_store(fname: str) -> DomData:
+def get_domdata_store(name: str, log: Callable[..., None] = print) -> DomData:
+    fname = DOMDATA_FNAME_TMPL.format(name)
     try:
-        with open(fname, "r") as fi:
-            jsondata = json.load(fi)
-            return {dom: set(jsondata[dom]) for dom in jsondata}
+        # The store must be a trusted local file: unpickling runs code, and with
+        # -f the path comes from the log file name. Refuse anyone else's file.
+        with open(fname, "rb") as fi:
+            if hasattr(os, "getuid") and os.fstat(fi.fileno()).st_uid != os.getuid():
+                log("🚨 Refusing to load store", fname, "not owned by current user")
+                raise SystemExit(1)
+
+            # the store is written from interned ids and pickle's memo stores
+            # each id once, so ids come back as one shared object each
+            return pickle.load(fi)
     except FileNotFoundError:
-        print("⚠️  No store found", fname)
+        pass
+
+    # fall back to a JSON store (an old store or an export); a store being
+    # migrated is moved aside after the first pickle write
+    json_fname = DOMDATA_JSON_FNAME_TMPL.format(name)
+    try:
+        with open(json_fname, "rb") as fi:
+            log("💾 Loading JSON store", json_fname)
+            jsondata: DomDataFile = json_loads(fi.read())
+            return {dom: set(map(sys.intern, jsondata[dom])) for dom in jsondata}
+    except FileNotFoundError:
+        log("⚠️  No store found", fname, "or", json_fname)
     return {}
 
 
-def update_domdata_store(name: str, domdata: DomData) -> DomData:
+def update_domdata_store(
+    name: str, domdata: DomData, domdata_store: DomData
+) -> DomData:
     fname = DOMDATA_FNAME_TMPL.format(name)
-
-    domdata_store = get_domdata_store(fname)
     combined: DomData = {}
 
     if not domdata_store and not domdata:
@@ -108,9 +169,9 @@ def update_domdata_store(name: str, domdata: DomData) -> DomData:
     # announce data that has changed
     for dom in domdata_store:
         if dom in domdata:
-            if set(domdata_store[dom]) != domdata[dom]:
+            if domdata_store[dom] != domdata[dom]:
                 print("⚠️  Blocklists used for {} changed".format(dom))
-                print("Was: {}".format(sorted(set(domdata_store[dom]))))
+                print("Was: {}".format(sorted(domdata_store[dom])))
                 print("Now: {}".format(sorted(domdata[dom])))
 
     # combine the store with the passed data; passed data overwrites
@@ -118,66 +179,100 @@ def update_domdata_store(name: str, domdata: DomData) -> DomData:
     combined.update(domdata)
 
     # write combined data to the store
-    with open(fname, "w") as fo:
-        json_data = {dom: list(combined[dom]) for dom in combined}
-        print("💾 Writing store", fname, "with", len(json_data), "domains")
-        json.dump(json_data, fo, indent=2)
+    migrating = not os.path.exists(fname)
+    with open(fname, "wb") as fo:
+        print("💾 Writing store", fname, "with", len(combined), "domains")
+        pickle.dump(combined, fo, protocol=5)
+
+    # the first pickle supersedes a JSON store; rename it so a stale copy is
+    # never loaded if the pickle goes missing
+    json_fname = DOMDATA_JSON_FNAME_TMPL.format(name)
+    if migrating and os.path.exists(json_fname):
+        os.replace(json_fname, json_fname + ".migrated")
+        print("💾 Moved old store", json_fname, "to", json_fname + ".migrated")
 
     return combined
 
 
+def export_domdata_store(name: str, domdata: DomData) -> None:
+    fname = DOMDATA_JSON_FNAME_TMPL.format(name)
+
+    with open(fname, "wb") as fo:
+        json_data: DomDataFile = {dom: sorted(domdata[dom]) for dom in domdata}
+        print("💾 Exporting store", fname, "with", len(json_data), "domains")
+        fo.write(json_dumps(json_data, indent=True))
+
+
+def print_lines(lines: list[str]) -> None:
+    # one write per report section instead of a print() per line
+    sys.stdout.write("\n".join(lines) + "\n")
+
+
 def print_domdata(domdata: DomData, args: argparse.Namespace) -> None:
-    print("⚙️  Processing {} domains".format(len(domdata)))
+    total = len(domdata)
+    print("⚙️  Processing {} domains".format(total))
 
     solos: dict[str, set[str]] = defaultdict(set)  # blist -> doms
-    combos: dict[tuple[str, ...], set[str]] = defaultdict(set)  # blists -> doms
+    combos: dict[frozenset[str], set[str]] = defaultdict(set)  # blists -> doms
     overlap: dict[str, list[int]] = defaultdict(list)  # blist -> redundancy
+    candidates: list[str] = []  # doms that might only appear in combos
 
-    for dom in domdata:
-        for blist in domdata[dom]:
-            overlap[blist].append(len(domdata[dom]))
+    for dom, blists in domdata.items():
+        n = len(blists)
+        for blist in blists:
+            overlap[blist].append(n)
 
-        if len(domdata[dom]) == 1:
-            blist = list(domdata[dom])[0]
+        if n == 1:
+            blist = next(iter(blists))
             solos[blist].add(dom)
-
-    # 2nd pass: find lists only appearing with other lists, but not the solos
-    for dom in domdata:
-        if solos.keys() & domdata[dom]:
+        else:
+            candidates.append(dom)
+
+    # find lists only appearing with other lists, but not the solos; solos
+    # aren't known until every domain is seen so only the candidates are swept
+    solos_keys = solos.keys()
+    for dom in candidates:
+        if not solos_keys.isdisjoint(domdata[dom]):
             continue
 
-        blists = tuple(sorted(domdata[dom]))
-        combos[blists].add(dom)
+        combos[frozenset(domdata[dom])].add(dom)
 
-    print("\n#\n# Blocklists appearing by themselves\n#\n")
-    print("domains\tid")
-    print("--     \t--")
+    out = [
+        "\n#\n# Blocklists appearing by themselves\n#\n",
+        "domains\tid",
+        "--     \t--",
+    ]
     for blist in sorted(solos):
-        print("{}\t{}\n\t{}".format(len(solos[blist]), blist, solos[blist]))
+        out.append("{}\t{}\n\t{}".format(len(solos[blist]), blist, solos[blist]))
+    print_lines(out)
 
     if combos:
-        print("\n#\n# Blocklists found only in combos\n#\n")
-        print("domains\tid")
-        print("--     \t--")
-        for blists in combos:
-            print("{}\t{}\n\t{}".format(len(combos[blists]), blists, combos[blists]))
+        out = [
+            "\n#\n# Blocklists found only in combos\n#\n",
+            "domains\tid",
+            "--     \t--",
+        ]
+        for blists, doms in combos.items():
+            out.append("{}\t{}\n\t{}".format(len(doms), tuple(sorted(blists)), doms))
+        print_lines(out)
 
     blistdata = domdata_to_blistdata(domdata)
-    coverage_pct: Callable[[str], float]
-    coverage_pct = lambda blist: len(blistdata[blist]) / len(domdata)
-    print("\n#\n# Domain coverage ({} total)\n#\n".format(len(domdata)))
-    for blist in sorted(blistdata, key=coverage_pct, reverse=True):
-        print("{:4.1f}% {}".format(100 * coverage_pct(blist), blist))
+    coverage = [(len(doms), blist) for blist, doms in blistdata.items()]
+    # ties are listed by name: sort on name, then a stable sort on count
+    coverage.sort(key=itemgetter(1))
+    coverage.sort(key=itemgetter(0), reverse=True)
+    out = ["\n#\n# Domain coverage ({} total)\n#\n".format(total)]
+    for count, blist in coverage:
+        out.append("{:4.1f}% {}".format(100 * count / total, blist))
+    print_lines(out)
 
     if args.histogram:
-        print("\n#\n# Redundancy histogram\n#\n")
+        out = ["\n#\n# Redundancy histogram\n#\n"]
         for blist in sorted(overlap):
-            level_hist: dict[int, int] = defaultdict(int)
-            for level in overlap[blist]:
-                level_hist[level] += 1
-            print(blist)
+            level_hist = Counter(overlap[blist])
+            out.append(blist)
 
-            for n in range(1, max(level_hist.keys()) + 1):
+            for n in range(1, max(level_hist) + 1):
                 level_str = "{:2d}".format(n)
                 if n == 1:
                     level_str = "🥇"
@@ -185,8 +280,9 @@ def print_domdata(domdata: DomData, args: argparse.Namespace) -> None:
                     level_str = "🥈"
                 if n == 3:
                     level_str = "🥉"
-                print("{}: {}".format(level_str, "*" * level_hist.get(n, 0)))
-            print()
+                out.append("{}: {}".format(level_str, "*" * level_hist.get(n, 0)))
+            out.append("")
+        print_lines(out)
 
 
 def get_args() -> argparse.Namespace:
@@ -201,6 +297,9 @@ def get_args() -> argparse.Namespace:
     parser.add_argument(
         "--histogram", help="Show overlap histogram", action="store_true"
     )
+    parser.add_argument(
+        "--export-json", help="Also write the store as JSON", action="store_true"
+    )
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("-p", "--profile")
@@ -218,24 +317,39 @@ def main():
     args = get_args()
     config = get_config(args.config)
     domdata: DomData = {}
+    domdata_store: DomData = {}
 
     if args.file:
         store_name = args.file.partition("-")[0]
         if not args.stats_only:
             domdata = get_file_data(args.file)
+            domdata_store = get_domdata_store(store_name)
     elif args.profile:
         api_key = os.environ.get("NEXTDNS_API_KEY", config["api_key"])
         store_name = profile_id = config["profiles"][args.profile]
         if not args.stats_only:
-            domdata = get_api_data(api_key, profile_id, args.keep)
+            # load the existing store while the logs download; its status
+            # lines are held back so the output order doesn't depend on timing
+            store_log: list[tuple[Any, ...]] = []
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                store_future = executor.submit(
+                    get_domdata_store, store_name, lambda *a: store_log.append(a)
+                )
+                domdata = get_api_data(api_key, profile_id, args.keep)
+            for line in store_log:
+                print(*line)
+            domdata_store = store_future.result()
     else:
         print("No profile or file specified!")  # shouldn't get here
         raise SystemExit(1)
 
     if args.stats_only:
-        domdata = get_domdata_store(DOMDATA_FNAME_TMPL.format(store_name))
+        domdata = get_domdata_store(store_name)
     else:
-        domdata = update_domdata_store(store_name, domdata)
+        domdata = update_domdata_store(store_name, domdata, domdata_store)
+
+    if args.export_json:
+        export_domdata_store(store_name, domdata)
     print_domdata(domdata, args)
 
 